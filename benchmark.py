@@ -0,0 +1,285 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy
+from pytz import timezone
+import report_engine
+from report_engine import CLAIMS_PAGE_LIMIT, DAY_PERIODS, DELIVERED_STATUSES, REPORT_RANGES, SECRETS_MAP, statuses
+
+BENCHMARK_SIZES = [1000, 10000, 100000]
+BENCHMARK_STORES = 40
+BENCHMARK_COURIERS = 300
+BENCHMARK_TITLES = ["Dog food 2.5 kg", "Cat food 10kgs", "Bird seed 500 gr", "Chew toy", "Aquarium filter 1 KG",
+                    "Litter 5 kg and scoop", "Vitamins"]
+STATUS_WEIGHTS = {"delivered_finish": 30, "delivered": 15, "pickuped": 10, "performer_lookup": 8,
+                  "performer_found": 8, "cancelled": 8, "returned_finish": 4, "returning": 3,
+                  "performer_not_found": 3, "delivery_arrived": 3, "pickup_arrived": 3, "new": 3, "failed": 2}
+SHEETS_DISCOVERY = {
+    "kind": "discovery#restDescription", "discoveryVersion": "v1", "id": "sheets:v4", "name": "sheets",
+    "version": "v4", "servicePath": "", "batchPath": "batch", "protocol": "rest",
+    "parameters": {"key": {"type": "string", "location": "query"}},
+    "resources": {"spreadsheets": {"resources": {"values": {"methods": {"batchGet": {
+        "id": "sheets.spreadsheets.values.batchGet", "path": "v4/spreadsheets/{spreadsheetId}/values:batchGet",
+        "httpMethod": "GET", "parameterOrder": ["spreadsheetId"], "response": {"$ref": "BatchGetValuesResponse"},
+        "parameters": {"spreadsheetId": {"type": "string", "required": True, "location": "path"},
+                       "ranges": {"type": "string", "repeated": True, "location": "query"}}}}}}}},
+    "schemas": {"BatchGetValuesResponse": {"id": "BatchGetValuesResponse", "type": "object"}}
+}
+
+
+def claim_days(client, period):
+    if period in REPORT_RANGES:
+        date_from, date_to = (datetime.date.fromisoformat(day) for day in REPORT_RANGES[period])
+    else:
+        today = datetime.datetime.now(timezone(report_engine.get_client_timezone(client))).date()
+        date_from = today - datetime.timedelta(days=max(DAY_PERIODS.values()))
+        date_to = today - datetime.timedelta(days=min(DAY_PERIODS.values()))
+    return [date_from + datetime.timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+
+
+def generate_claims(client, period, size, seed=0):
+    # Claims shaped like the API response, spread over the days the period reads
+    rnd = random.Random(seed)
+    client_timezone = timezone(report_engine.get_client_timezone(client))
+    days = claim_days(client, period)
+    claims = []
+    for number in range(size):
+        day = days[number * len(days) // size]
+        cutoff = client_timezone.localize(datetime.datetime.combine(day, datetime.time(rnd.randint(6, 21))))
+        created = cutoff - datetime.timedelta(hours=rnd.randint(1, 30))
+        status = rnd.choices(list(STATUS_WEIGHTS), weights=list(STATUS_WEIGHTS.values()))[0]
+        store = number % BENCHMARK_STORES
+        claim = {
+            "id": f"{number:032x}",
+            "status": status,
+            "created_ts": created.isoformat(),
+            "updated_ts": (cutoff + datetime.timedelta(minutes=rnd.randint(0, 180))).isoformat(),
+            "same_day_data": {"delivery_interval": {"from": cutoff.isoformat(),
+                                                    "to": (cutoff + datetime.timedelta(hours=2)).isoformat()}},
+            "items": [{"title": rnd.choice(BENCHMARK_TITLES), "cost_value": f"{rnd.uniform(0, 900):.2f}",
+                       "quantity": rnd.randint(1, 3)} for _ in range(rnd.randint(1, 4))],
+            "route_points": [
+                {"id": number * 2, "type": "source",
+                 "address": {"fullname": f"Store street {store}, building {store % 7}",
+                             "coordinates": [-99.2 + store * 0.01, 19.3 + store * 0.01]},
+                 "contact": {"name": f"Store {store}", "phone": f"+5255{store:08d}"}},
+                {"id": number * 2 + 1, "type": "destination", "external_order_id": f"BENCH{number}",
+                 "address": {"fullname": f"Receiver street {number}, apartment {number % 90}",
+                             "coordinates": [-99.3 + rnd.random() * 0.3, 19.2 + rnd.random() * 0.3]},
+                 "contact": {"name": f"Receiver {number}", "phone": f"+5255{number:08d}"}}
+            ]
+        }
+        if rnd.random() < 0.7:
+            claim["comment"] = f"Order {number}, call before arrival"
+        if statuses.get(status, {}).get("type", "1. created") != "1. created":
+            courier = rnd.randrange(BENCHMARK_COURIERS)
+            claim["performer_info"] = {"courier_name": f"Courier {courier}", "legal_name": f"Park {courier % 12}"}
+            claim["route_id"] = f"route-{day}-{courier}"
+        if status in ["returned_finish", "returning"]:
+            claim["route_points"][1]["return_reasons"] = ["client_refused"]
+            claim["route_points"][1]["return_comment"] = "Nobody at home"
+        if statuses.get(status, {}).get("type") == "X. cancelled":
+            claim["autocancel_reason"] = "performer_not_found"
+        claims.append(claim)
+    return claims
+
+
+def sheet_columns(claims, seed=0):
+    # POD photos for most delivered orders, deposits for some of them
+    rnd = random.Random(seed)
+    delivered = [claim["route_points"][1]["external_order_id"] for claim in claims
+                 if claim["status"] in DELIVERED_STATUSES]
+    pod_orders = [order for order in delivered if rnd.random() < 0.8]
+    cod_orders = [order for order in delivered if rnd.random() < 0.3]
+    return {"A:A": [[order] for order in pod_orders],
+            "C:C": [[f"TRK {order}"] for order in cod_orders],
+            "E:E": [[f"https://example.com/deposits/{order}"] for order in cod_orders]}
+
+
+def serve_stand_in(client, period, size, api_latency, ready):
+    # Runs in its own process, so serializing pages doesn't compete with the report build for the GIL
+    claims = generate_claims(client, period, size)
+    columns = sheet_columns(claims)
+    created_times = [datetime.datetime.fromisoformat(claim["created_ts"]) for claim in claims]
+    pages = {}  # cursor -> encoded page
+    windows = {}  # (created_from, created_to) -> first cursor
+    windows_lock = threading.Lock()
+
+    def first_page(created_from, created_to):
+        window = (created_from, created_to)
+        created_from, created_to = datetime.datetime.fromisoformat(created_from), \
+            datetime.datetime.fromisoformat(created_to)
+        with windows_lock:
+            if window in windows:
+                return windows[window]
+            selected = [claim for claim, created in zip(claims, created_times) if created_from <= created < created_to]
+            cursors = [f"{len(pages) + offset}" for offset in range(max(1, -(-len(selected) // CLAIMS_PAGE_LIMIT)))]
+            for offset, cursor in enumerate(cursors):
+                page = {"claims": selected[offset * CLAIMS_PAGE_LIMIT:(offset + 1) * CLAIMS_PAGE_LIMIT]}
+                if offset + 1 < len(cursors):
+                    page["cursor"] = cursors[offset + 1]
+                pages[cursor] = json.dumps(page).encode()
+            windows[window] = cursors[0]
+            return cursors[0]
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, body):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            cursor = payload.get("cursor") or first_page(payload["created_from"], payload["created_to"])
+            time.sleep(api_latency)
+            self.reply(pages[cursor])
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/discovery":
+                root_url = f"http://{self.headers['Host']}/"
+                self.reply(json.dumps({**SHEETS_DISCOVERY, "rootUrl": root_url, "baseUrl": root_url}).encode())
+            elif url.path.endswith("/values:batchGet"):
+                ranges = parse_qs(url.query).get("ranges", [])
+                self.reply(json.dumps({"valueRanges": [{"range": value_range, "values": columns.get(value_range, [])}
+                                                       for value_range in ranges]}).encode())
+            else:
+                self.send_error(404)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+@contextlib.contextmanager
+def stand_in(client, period, size, api_latency):
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=serve_stand_in, args=(client, period, size, api_latency, sender),
+                                      daemon=True)
+    process.start()
+    try:
+        yield f"http://127.0.0.1:{receiver.recv()}"
+    finally:
+        process.terminate()
+        process.join()
+
+
+def reset_caches():
+    report_engine.get_report_cache.cache_clear()
+    report_engine.get_pod_orders.cache_clear()
+    report_engine.get_cod_orders.cache_clear()
+    with report_engine.TITLE_WEIGHTS_LOCK:
+        report_engine.TITLE_WEIGHTS.clear()
+    with report_engine.stage_log_lock:
+        report_engine.stage_log.clear()
+
+
+def run_benchmark(client, period, size, api_latency, work_dir, claim_store=False):
+    with stand_in(client, period, size, api_latency) as url:
+        report_engine.configure({
+            "API_URL": f"{url}/claims",
+            "CLAIM_SECRETS": ["benchmark"] * len(SECRETS_MAP),
+            "SHEET_KEY": "benchmark", "SHEET_ID": "pod",
+            "COD_SHEET_KEY": "benchmark", "COD_SHEET_ID": "cod",
+            "SHEETS_DISCOVERY_URL": f"{url}/discovery",
+            "CLAIM_STORE_PATH": os.path.join(work_dir, f"claims_{size}.sqlite") if claim_store else "",
+            "PRECOMPUTED_REPORTS_DIR": os.path.join(work_dir, "precomputed"),
+            "EXPORTS_DIR": os.path.join(work_dir, "exports")
+        })
+        reset_caches()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            report, routes_not_taken, pod_provision_rate, delivered_today, filter_index, aggregates = \
+                report_engine.get_cached_report(client, period)
+            report_ready = time.perf_counter()
+            with report_engine.timed_stage("map_prep", client, period=period, rows=len(report)):
+                report_engine.build_map_data(report, filter_index, numpy.arange(len(report)))
+            for export_format in report_engine.EXPORT_FORMATS:
+                report_engine.get_cached_export(client, period, report, export_format)
+        finished = time.perf_counter()
+    stages = report_engine.get_stage_timings(client)
+    stage_ms = stages.assign(stage=stages["stage"].where(stages["stage"] != "export",
+                                                         "export_" + stages["format"].astype(str))) \
+        .groupby("stage")["ms"].sum().round(1).to_dict()
+    api_pages = stages[stages["stage"] == "api_page"]
+    return {"client": client, "period": period, "claims": size, "rows": len(report),
+            "report_s": round(report_ready - started, 3), "end_to_end_s": round(finished - started, 3),
+            "peak_memory_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), "api_pages": len(api_pages),
+            "api_mb": round(api_pages["bytes"].sum() / 1024 ** 2, 1), "stages_ms": stage_ms}
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # A run regresses when it is slower or bigger than the baseline run of the same size by more than tolerance
+    regressions = []
+    baseline_runs = {(run["period"], run["claims"]): run for run in baseline}
+    for run in results:
+        previous = baseline_runs.get((run["period"], run["claims"]))
+        if not previous:
+            continue
+        for metric in ["end_to_end_s", "peak_memory_mb"]:
+            if run[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{run['period']} {run['claims']} claims: {metric} {previous[metric]} -> "
+                                   f"{run[metric]}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time report builds against synthetic claims served locally")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCHMARK_SIZES)
+    parser.add_argument("--client", default="Petco", choices=list(SECRETS_MAP))
+    parser.add_argument("--period", default="Today", choices=[*DAY_PERIODS, *REPORT_RANGES])
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds the stand-in API waits per page")
+    parser.add_argument("--claim-store", action="store_true", help="build through a fresh SQLite claim store")
+    parser.add_argument("--output", help="write the results as JSON, to be used as a later --baseline")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown or growth over the baseline")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in args.sizes:
+            # A fresh interpreter per size keeps caches cold and makes the peak RSS belong to this size only
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                result = executor.submit(run_benchmark, args.client, args.period, size, args.api_latency, work_dir,
+                                         args.claim_store).result()
+            results.append(result)
+            print(f"{size} claims: {result['rows']} rows, report {result['report_s']}s, "
+                  f"end to end {result['end_to_end_s']}s, peak {result['peak_memory_mb']} MB, "
+                  f"{result['api_pages']} pages / {result['api_mb']} MB from the API")
+            for stage, stage_ms in sorted(result["stages_ms"].items(), key=lambda item: -item[1]):
+                print(f"    {stage:<18}{stage_ms:>10} ms")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_with_baseline(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
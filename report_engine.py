@@ -0,0 +1,1203 @@
+import argparse
+import datetime
+import functools
+import os
+import requests
+import json
+import pandas
+import numpy
+import itertools
+import time
+import re
+import sys
+import queue
+import sqlite3
+import threading
+import cachetools
+import hashlib
+import tempfile
+import toml
+import pyarrow
+import pyarrow.parquet
+import xlsxwriter
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pytz import timezone
+from googleapiclient import discovery
+from googleapiclient.http import build_http
+
+try:
+    import orjson
+    parse_json = orjson.loads
+except ImportError:
+    parse_json = json.loads
+
+SECRETS_PATH = os.environ.get("REPORT_SECRETS_PATH", ".streamlit/secrets.toml")
+SHEETS_CACHE_TTL = 3600  # seconds, the POD sheet is synchronized hourly, SHEETS_CACHE_TTL secret overrides it
+SHEETS_DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+API_TIMEOUT = (5, 60)  # (connect, read) seconds
+API_RETRIES = 4
+API_RETRY_BACKOFF = 0.5
+API_MAX_WORKERS = 8  # concurrent cursor chains per report
+CLAIMS_PAGE_LIMIT = 1000
+RANGE_SLICE_DAYS = 1
+REPORT_CACHE_TTL = 600  # seconds before a cached report is rebuilt
+REPORT_CACHE_MAX_ENTRIES = 64
+REPORT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+FLEET_MAX_WORKERS = 4  # clients built at the same time for the fleet overview
+API_BUILD_SLOTS = 4  # report builds crawling the API at the same time in one process, sessions and prefetcher alike
+PREFETCH_INTERVAL = 600  # seconds between refreshes of the hot clients, divides the hour
+PREFETCH_OFFSET = 120  # seconds after XX:00, once the hourly POD sheet sync is done
+SECRETS_MAP = {"Petco": 0,
+               "Pets Table": 1,
+               "Huevos": 2,
+               "Inkovsky": 3,
+               "Baby Creisy": 4,
+               "Vigilancia Network": 5,
+               "Lens Market": 6,
+               "Ebebek": 7,
+               "Supplementer": 8,
+               "Sadece-eczane": 9,
+               "Osevio Internet Hizmetleri": 10,
+               "Mevsimi": 11,
+               "Candy Gift": 12,
+               "Akel": 13,
+               "Espresso Perfetto": 14,
+               "Ceviz Agaci": 15,
+               "Guven Sanat": 16}
+
+ISTANBUL_CLIENTS = [6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]  # SECRETS_MAP indexes of clients operating in Turkey
+
+
+REPORT_COLUMNS = ["cutoff", "client_id", "claim_id", "pod_point_id", "comment",
+                  "pickup_address", "receiver_address", "receiver_phone",
+                  "receiver_name", "status", "status_time",
+                  "store_name", "courier_name", "courier_park",
+                  "return_reason", "return_comment", "cancel_comment",
+                  "route_id", "lon", "lat", "store_lon", "store_lat", "price_of_goods", "items",
+                  "extracted_weight", "type", "is_final"]
+
+DAY_PERIODS = {"Today": 0, "Yesterday": 1, "Tomorrow": -1}  # days back from the client's current date
+REPORT_RANGES = {"Monthly": ("2023-06-01", "2023-06-30"),
+                 "May": ("2023-05-01", "2023-05-31")}
+EXPORT_FORMATS = ["xlsx", "csv", "parquet"]
+EXPORT_MIME_TYPES = {"xlsx": "application/vnd.ms-excel", "csv": "text/csv", "parquet": "application/octet-stream"}
+EXPORT_CHUNK_ROWS = 10000
+EXPORT_CACHE_MAX_FILES = 200
+MAP_IN_DELIVERY_COLOR = [200, 30, 0, 160]
+MAP_STATUS_COLORS = [(['delivered', 'delivered_finish'], [11, 102, 35, 160]),
+                     (['cancelled', 'cancelled_by_taxi'], [215, 210, 203, 200]),
+                     (['returning', 'returned_finish', 'return_arrived'], [237, 139, 0, 160])]
+MAP_ORDER_COLUMNS = ["lon", "lat", "store_name", "cutoff", "courier_name", "status", "client_id", "claim_id"]
+MAP_GRID_DEGREES = 0.01  # roughly 1 km cells once a map has to be aggregated
+TABLE_PAGE_SIZES = [50, 100, 250, 500]
+STAGE_LOG_SIZE = 2000  # most recent stage timings kept in memory for the dashboard
+
+statuses = {
+    'delivered': {'type': '4. delivered', 'state': 'in progress'},
+    'pickuped': {'type': '3. pickuped', 'state': 'in progress'},
+    'returning': {'type': '3. pickuped', 'state': 'in progress'},
+    'cancelled_by_taxi': {'type': 'X. cancelled', 'state': 'final'},
+    'delivery_arrived': {'type': '3. pickuped', 'state': 'in progress'},
+    'cancelled': {'type': 'X. cancelled', 'state': 'final'},
+    'performer_lookup': {'type': '1. created', 'state': 'in progress'},
+    'performer_found': {'type': '2. assigned', 'state': 'in progress'},
+    'performer_draft': {'type': '1. created', 'state': 'in progress'},
+    'returned': {'type': 'R. returned', 'state': 'in progress'},
+    'returned_finish': {'type': 'R. returned', 'state': 'final'},
+    'performer_not_found': {'type': 'X. cancelled', 'state': 'final'},
+    'return_arrived': {'type': '3. pickuped', 'state': 'in progress'},
+    'delivered_finish': {'type': '4. delivered', 'state': 'final'},
+    'failed': {'type': 'X. cancelled', 'state': 'final'},
+    'accepted': {'type': '1. created', 'state': 'in progress'},
+    'new': {'type': '1. created', 'state': 'in progress'},
+    'pickup_arrived': {'type': '2. assigned', 'state': 'in progress'},
+    'estimating_failed': {'type': 'X. cancelled', 'state': 'final'},
+    'cancelled_with_payment': {'type': 'X. cancelled', 'state': 'final'}
+}
+
+STATUS_TYPES = {status: state['type'] for status, state in statuses.items()}
+STATUS_STATES = {status: state['state'] for status, state in statuses.items()}
+FLATTENED_COLUMNS = REPORT_COLUMNS[1:REPORT_COLUMNS.index("store_lat") + 1]  # read straight from the claim JSON
+
+_secrets = None
+
+
+def configure(secrets):
+    # The dashboard hands over st.secrets, headless runs read the same secrets.toml from SECRETS_PATH
+    global _secrets
+    _secrets = secrets
+
+
+def get_secrets():
+    global _secrets
+    if _secrets is None:
+        _secrets = toml.load(SECRETS_PATH)
+    return _secrets
+
+
+def get_client_timezone(client):
+    return "Europe/Istanbul" if SECRETS_MAP[client] in ISTANBUL_CLIENTS else "America/Mexico_City"
+
+
+stage_log = deque(maxlen=STAGE_LOG_SIZE)
+stage_log_lock = threading.Lock()
+
+
+def log_stage(stage, client, seconds, **details):
+    # One JSON line per finished stage on stdout, the same entries are kept for get_stage_timings
+    entry = {"at": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"), "stage": stage,
+             "client": client, "ms": round(seconds * 1000, 1), **details}
+    with stage_log_lock:
+        stage_log.append(entry)
+    print(json.dumps(entry, default=str))
+
+
+@contextmanager
+def timed_stage(stage, client=None, **details):
+    # Details added to the yielded dict inside the block are logged with the timing
+    started = time.perf_counter()
+    try:
+        yield details
+    except Exception as error:
+        details["error"] = repr(error)
+        raise
+    finally:
+        log_stage(stage, client, time.perf_counter() - started, **details)
+
+
+def get_stage_timings(client=None) -> pandas.DataFrame:
+    with stage_log_lock:
+        entries = [entry for entry in stage_log if client is None or entry["client"] in (client, None)]
+    return pandas.DataFrame(entries[::-1])
+
+
+EARTH_RADIUS_KM = 6371.0088  # same mean radius haversine uses for Unit.KILOMETERS
+DELIVERED_STATUSES = ["delivered", "delivered_finish"]
+CATEGORICAL_COLUMNS = ["status", "type", "is_final", "proof", "store_name", "courier_name", "courier_park", "route_id",
+                       "pickup_address"]
+COORDINATE_COLUMNS = ["lon", "lat", "store_lon", "store_lat"]
+FILTER_COLUMNS = ["status", "type", "store_name", "courier_name", "proof"]
+WEIGHT_PATTERN = re.compile(r"(\d*\.?\d+)\s*(kgs?)\b", flags=re.IGNORECASE)
+TITLE_WEIGHTS = cachetools.LRUCache(maxsize=100000)  # item title -> kg
+TITLE_WEIGHTS_LOCK = threading.Lock()
+FLEET_SUMMARIES = cachetools.LRUCache(maxsize=16)  # (period, report versions) -> (fleet summary, orders)
+FLEET_SUMMARIES_LOCK = threading.Lock()
+KPI_DIMENSIONS = ["store_name", "cutoff", "courier_name", "route_id", "status", "type", "proof"]
+
+
+def calculate_distance(frame):
+    lat, lon, store_lat, store_lon = (numpy.radians(frame[column].to_numpy(dtype=float))
+                                      for column in ["lat", "lon", "store_lat", "store_lon"])
+    d = numpy.sin((store_lat - lat) * 0.5) ** 2 + \
+        numpy.cos(lat) * numpy.cos(store_lat) * numpy.sin((store_lon - lon) * 0.5) ** 2
+    frame["linear_distance"] = numpy.round(2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(d)), 2)
+    return frame
+
+
+@functools.lru_cache(maxsize=None)
+def get_sheets_service(developer_key, discovery_url=SHEETS_DISCOVERY_URL):
+    return discovery.build('sheets', 'v4', discoveryServiceUrl=discovery_url, developerKey=developer_key)
+
+
+def cached_sheet_lookup(function):
+    # Keeps one result per process for the SHEETS_CACHE_TTL secret, only one thread at a time reads the sheet.
+    # The cache is made on first use, after configure() has provided the secrets.
+    cache = None
+    lock = threading.Lock()
+
+    @functools.wraps(function)
+    def wrapper():
+        nonlocal cache
+        with lock:
+            if cache is None:
+                cache = cachetools.TTLCache(maxsize=1, ttl=get_secrets().get("SHEETS_CACHE_TTL", SHEETS_CACHE_TTL))
+            if "result" not in cache:
+                cache["result"] = function()
+            return cache["result"]
+
+    def cache_clear():
+        nonlocal cache
+        with lock:
+            cache = None
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
+
+def get_sheet_columns(developer_key, spreadsheet_id, ranges):
+    with timed_stage("sheet_read", ranges=ranges) as details:
+        service = get_sheets_service(developer_key, get_secrets().get("SHEETS_DISCOVERY_URL", SHEETS_DISCOVERY_URL))
+        request = service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges)
+        # The service is shared between threads but its own httplib2.Http isn't thread-safe, so every read gets one
+        response = request.execute(http=build_http())
+        columns = [[item for sublist in value_range.get("values", []) for item in sublist]
+                   for value_range in response["valueRanges"]]
+        details["rows"] = max(map(len, columns), default=0)
+    return columns
+
+
+@cached_sheet_lookup
+def get_pod_orders():
+    # Shared by all sessions and clients, treat the returned set as read-only
+    pod_orders, = get_sheet_columns(get_secrets()["SHEET_KEY"], get_secrets()["SHEET_ID"], ['A:A'])
+    return frozenset(pod_orders)
+
+
+def check_for_pod(frame, orders_with_pod):
+    delivered = frame["status"].isin(DELIVERED_STATUSES).to_numpy()
+    with_pod = frame["client_id"].astype(str).isin(orders_with_pod).to_numpy()
+    frame["proof"] = numpy.select([~delivered, with_pod], ["-", "Proof provided"], "No proof")
+    return frame
+
+
+@cached_sheet_lookup
+def get_cod_orders():
+    # Shared by all sessions and clients, treat the returned dict as read-only
+    cod_orders, cod_links = get_sheet_columns(get_secrets()["COD_SHEET_KEY"], get_secrets()["COD_SHEET_ID"],
+                                              ['C:C', 'E:E'])
+    cod_orders = [item.replace(' ', '').replace('TRK', '') for item in cod_orders]
+
+    orders_with_links = dict(zip(cod_orders, cod_links))
+    return orders_with_links
+
+
+def check_for_cod(frame, orders_with_cod: dict):
+    prepaid = (frame["price_of_goods"] < 1).to_numpy()
+    delivered = frame["status"].isin(DELIVERED_STATUSES).to_numpy()
+    cod_links = frame["client_id"].astype(str).map(orders_with_cod)
+    with_cod = cod_links.notna().to_numpy()
+    frame["cash_collected"] = numpy.select([prepaid, ~delivered, with_cod], ["Prepaid", "-", "Deposit verified"],
+                                           "Not verified")
+    frame["cash_prooflink"] = numpy.select([prepaid, ~delivered, with_cod], ["Prepaid", "-", cod_links.to_numpy()],
+                                           "No link")
+    return frame
+
+  
+def flag_late_routes(pivot, option, client_timezone):
+    # Adds minutes_late and concern (0, 1 for 🙀, 3 for 🙀🙀🙀) and appends the flags to cutoff, one array operation
+    # per column. Only routes with more than one claim still created / assigned (or pickuped, yesterday) are flagged.
+    def pending(column):
+        return pandas.to_numeric(pivot[column], errors="coerce").fillna(0).to_numpy() > 1 if column in pivot \
+            else numpy.zeros(len(pivot), dtype=bool)
+
+    if option == "Today":
+        now = datetime.datetime.now(timezone(client_timezone)).replace(tzinfo=None)
+        cutoff_time = pandas.Timestamp(now.date()) + pandas.to_timedelta(pivot["cutoff"].astype(str) + ":00",
+                                                                         errors="coerce")
+        minutes_late = (numpy.floor((pandas.Timestamp(now) - cutoff_time).dt.total_seconds()) / 60) \
+            .clip(lower=0).fillna(0).to_numpy()
+        waiting = pending("1. created") | pending("2. assigned")
+        concern = numpy.select([waiting & (minutes_late >= 30), waiting & (minutes_late >= 10)], [3, 1], 0)
+    elif option == "Yesterday":
+        minutes_late = numpy.full(len(pivot), 999.0)  # magic number that is >30
+        concern = numpy.where(pending("2. assigned") | pending("3. pickuped"), 3, 0)
+    else:
+        minutes_late = numpy.zeros(len(pivot))
+        concern = numpy.zeros(len(pivot), dtype=int)
+    flags = numpy.select([concern == 3, concern == 1], [" 🙀🙀🙀", " 🙀"], "")
+    return pivot.assign(cutoff=pivot["cutoff"].astype(str) + flags, minutes_late=minutes_late, concern=concern)
+
+
+@functools.lru_cache(maxsize=None)
+def get_claims_session() -> requests.Session:
+    session = requests.Session()
+    retries = Retry(total=API_RETRIES,
+                    backoff_factor=API_RETRY_BACKOFF,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=None,  # cursor reads are idempotent, so retry POST as well
+                    respect_retry_after_header=True)
+    # One connection per cursor chain that can run at once, pool_block keeps any extra thread waiting for a free
+    # keep-alive connection instead of opening one that gets thrown away
+    pool_size = API_MAX_WORKERS * get_secrets().get("API_BUILD_SLOTS", API_BUILD_SLOTS)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        'Content-Type': 'application/json',
+        'Accept-Language': 'en',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'Connection': 'keep-alive'
+    })
+    return session
+
+
+def get_claims(client, date_from, date_to, cursor=0):
+    url = get_secrets()["API_URL"]
+
+    timezone_offset = "+03:00" if SECRETS_MAP[client] in ISTANBUL_CLIENTS else "-06:00"
+    # Ends at midnight after date_to rather than 23:59:59, so claims created within the last second of a day aren't
+    # lost between two slices. A claim created exactly at midnight lands in both and iter_claim_slices drops the copy.
+    next_day = datetime.date.fromisoformat(date_to) + datetime.timedelta(days=1)
+    payload = json.dumps({
+        "created_from": f"{date_from}T00:00:00{timezone_offset}",
+        "created_to": f"{next_day}T00:00:00{timezone_offset}",
+        "limit": CLAIMS_PAGE_LIMIT,
+        "cursor": cursor
+    }) if cursor == 0 else json.dumps({"cursor": cursor})
+
+    client_secret = get_secrets()["CLAIM_SECRETS"][SECRETS_MAP[client]]
+
+    headers = {
+        'Authorization': f"Bearer {client_secret}"
+    }
+
+    with timed_stage("api_page", client, date_from=date_from, date_to=date_to) as details:
+        response = get_claims_session().post(url, headers=headers, data=payload, timeout=API_TIMEOUT)
+        response.raise_for_status()
+        claims = parse_json(response.content)
+        cursor = claims.get('cursor')
+        details.update(bytes=len(response.content), claims=len(claims['claims']), last_page=cursor is None,
+                       api_ms=round(response.elapsed.total_seconds() * 1000, 1))
+    return claims['claims'], cursor
+
+
+def iter_claim_pages(client, date_from, date_to):
+    # Prefetch the next page in the background while the caller processes the current one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(get_claims, client, date_from, date_to)
+        while next_page:
+            page_claims, cursor = next_page.result()
+            next_page = executor.submit(get_claims, client, date_from, date_to, cursor) if cursor else None
+            yield page_claims
+
+
+def split_date_range(date_from, date_to, slice_days=RANGE_SLICE_DAYS):
+    start = datetime.datetime.strptime(date_from, "%Y-%m-%d").date()
+    end = datetime.datetime.strptime(date_to, "%Y-%m-%d").date()
+    slices = []
+    while start <= end:
+        slice_end = min(start + datetime.timedelta(days=slice_days - 1), end)
+        slices.append((start.strftime("%Y-%m-%d"), slice_end.strftime("%Y-%m-%d")))
+        start = slice_end + datetime.timedelta(days=1)
+    return slices
+
+
+def iter_claim_slices(client, slices, max_workers=API_MAX_WORKERS):
+    # Walk every slice's cursor chain in parallel and yield (slice, page claims, is last page of the slice) as pages
+    # arrive. The bounded queue holds back the workers when pages pile up, so only a few pages are alive at a time.
+    pages = queue.Queue(maxsize=2 * max_workers)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def walk_slice(slice_from, slice_to):
+        try:
+            page_claims, cursor = get_claims(client, slice_from, slice_to)
+            put(((slice_from, slice_to), page_claims, not cursor))
+            while cursor and not stop.is_set():
+                page_claims, cursor = get_claims(client, slice_from, slice_to, cursor)
+                put(((slice_from, slice_to), page_claims, not cursor))
+        except Exception as error:
+            put(error)
+
+    seen_ids = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for slice_from, slice_to in slices:
+                executor.submit(walk_slice, slice_from, slice_to)
+            slices_left = len(slices)
+            while slices_left:
+                item = pages.get()
+                if isinstance(item, Exception):
+                    raise item
+                claims_slice, page_claims, last_page = item
+                slices_left -= last_page
+                unseen_claims = [claim for claim in page_claims if claim['id'] not in seen_ids]
+                seen_ids.update(claim['id'] for claim in unseen_claims)
+                yield claims_slice, unseen_claims, last_page
+        finally:
+            stop.set()
+
+
+def iter_sliced_claim_pages(client, date_from, date_to, slice_days=RANGE_SLICE_DAYS, max_workers=API_MAX_WORKERS):
+    for _, page_claims, _ in iter_claim_slices(client, split_date_range(date_from, date_to, slice_days), max_workers):
+        yield page_claims
+
+
+def get_claim_store_path():
+    # An empty CLAIM_STORE_PATH secret disables incremental sync
+    return get_secrets().get("CLAIM_STORE_PATH", "claim_store.sqlite")
+
+
+def open_claim_store():
+    store = sqlite3.connect(get_claim_store_path(), timeout=30)
+    store.execute("CREATE TABLE IF NOT EXISTS claims (client TEXT, claim_id TEXT, created_date TEXT, updated_ts TEXT, "
+                  "is_final INTEGER, body TEXT, PRIMARY KEY (client, claim_id))")
+    store.execute("CREATE TABLE IF NOT EXISTS settled_days (client TEXT, created_date TEXT, "
+                  "PRIMARY KEY (client, created_date))")
+    store.execute("CREATE INDEX IF NOT EXISTS claims_by_day ON claims (client, created_date)")
+    return store
+
+
+def claim_store_windows(client_today):
+    # Every created-date window a report reads: the day periods' window and each report range from three days
+    # before its start, which covers get_report's two days plus the shift to the client's timezone
+    today = datetime.date.fromisoformat(client_today)
+    windows = [((today - datetime.timedelta(days=max(DAY_PERIODS.values()) + 3)).isoformat(),
+                (today - datetime.timedelta(days=min(DAY_PERIODS.values()))).isoformat())]
+    for start_, end_ in REPORT_RANGES.values():
+        windows.append(((datetime.date.fromisoformat(start_) - datetime.timedelta(days=3)).isoformat(), end_))
+    return windows
+
+
+def prune_claim_store(store, client, client_today):
+    # Days no report window reads any more are dropped, so the store doesn't keep every claim ever fetched
+    windows = claim_store_windows(client_today)
+    outside_windows = " AND ".join(["created_date NOT BETWEEN ? AND ?"] * len(windows))
+    with store:
+        for table in ["claims", "settled_days"]:
+            store.execute(f"DELETE FROM {table} WHERE client = ? AND {outside_windows}",
+                          [client, *itertools.chain.from_iterable(windows)])
+
+
+def iter_synced_claim_pages(client, date_from, date_to, client_today):
+    # A past day whose claims are all in a final state never changes again, so it is served from the local store
+    # and only the remaining days are fetched from the API
+    with closing(open_claim_store()) as store:
+        prune_claim_store(store, client, client_today)
+        settled_days = {row[0] for row in store.execute(
+            "SELECT created_date FROM settled_days WHERE client = ? AND created_date BETWEEN ? AND ?",
+            (client, date_from, date_to))}
+        stored_ids = set()  # a claim created exactly at midnight may also come back with the next day's slice
+        for day in sorted(settled_days):
+            rows = store.execute("SELECT body FROM claims WHERE client = ? AND created_date = ?", (client, day))
+            for page_rows in iter(lambda: rows.fetchmany(CLAIMS_PAGE_LIMIT), []):
+                page_claims = [parse_json(row[0]) for row in page_rows]
+                stored_ids.update(claim['id'] for claim in page_claims)
+                yield page_claims
+        days_to_sync = [(day, day) for day, _ in split_date_range(date_from, date_to, 1) if day not in settled_days]
+        # Claims whose updated_ts didn't move since the last sync aren't serialized and written again
+        stored_versions = dict(store.execute(
+            "SELECT claim_id, updated_ts FROM claims WHERE client = ? AND created_date BETWEEN ? AND ?",
+            (client, date_from, date_to)))
+        days_final = {}
+        for (day, _), page_claims, last_page in iter_claim_slices(client, days_to_sync):
+            finality = [statuses.get(claim['status'], {}).get('state') == 'final' for claim in page_claims]
+            days_final[day] = days_final.get(day, True) and all(finality)
+            with store:
+                store.executemany(
+                    "INSERT INTO claims VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (client, claim_id) DO UPDATE SET "
+                    "updated_ts = excluded.updated_ts, is_final = excluded.is_final, body = excluded.body "
+                    "WHERE excluded.updated_ts != claims.updated_ts",
+                    [(client, claim['id'], day, claim['updated_ts'], is_final, json.dumps(claim))
+                     for claim, is_final in zip(page_claims, finality)
+                     if stored_versions.get(claim['id']) != claim['updated_ts']])
+                if last_page and day < client_today and days_final[day]:
+                    store.execute("INSERT OR IGNORE INTO settled_days VALUES (?, ?)", (client, day))
+            yield [claim for claim in page_claims if claim['id'] not in stored_ids]
+
+
+def get_title_weights(titles):
+    # kg parsed from item titles, the same SKUs recur constantly so parsed titles are memoized across pages
+    with TITLE_WEIGHTS_LOCK:
+        weights = {title: TITLE_WEIGHTS[title] for title in set(titles) if title in TITLE_WEIGHTS}
+    new_titles = [title for title in set(titles) if title not in weights]
+    if new_titles:
+        extracted = pandas.Series(new_titles, dtype=object).str.extract(WEIGHT_PATTERN)[0].astype(float).fillna(0.0)
+        weights.update(zip(new_titles, extracted))
+        with TITLE_WEIGHTS_LOCK:
+            TITLE_WEIGHTS.update(zip(new_titles, extracted))
+    return [weights[title] for title in titles]
+
+
+def summarize_items(page_claims) -> pandas.DataFrame:
+    # One pass over the items builds the goods text and flags claims with an item missing its title or cost, prices
+    # and memoized weights are then summed per claim. Like before, a claim without items, or with an item missing its
+    # title or cost, gets the default for that column.
+    positions, titles, costs, goods = [], [], [], []
+    bad_title = numpy.zeros(len(page_claims), dtype=bool)
+    bad_cost = numpy.zeros(len(page_claims), dtype=bool)
+    for position, claim in enumerate(page_claims):
+        claim_items = claim.get('items')
+        if not isinstance(claim_items, list):
+            bad_title[position] = bad_cost[position] = True
+            goods.append("")
+            continue
+        claim_goods = ""
+        for item in claim_items:
+            item = item if isinstance(item, dict) else {}
+            if 'title' in item:
+                title = str(item['title'])
+                claim_goods += title + " |"
+            else:
+                title = ""
+                bad_title[position] = True
+            try:
+                cost = float(item['cost_value'])
+            except (KeyError, TypeError, ValueError):
+                cost = numpy.nan
+            if cost != cost:
+                bad_cost[position] = True
+            positions.append(position)
+            titles.append(title)
+            costs.append(cost)
+        goods.append(claim_goods)
+    positions = numpy.array(positions, dtype=numpy.intp)
+    price_of_goods = numpy.bincount(positions, weights=costs, minlength=len(page_claims))
+    weight_kg = numpy.bincount(positions, weights=get_title_weights(titles), minlength=len(page_claims))
+    return pandas.DataFrame({
+        "price_of_goods": numpy.where(bad_cost, 0.0, price_of_goods),
+        "items": numpy.where(bad_title, "Not specified", numpy.array(goods, dtype=object)),
+        "extracted_weight": numpy.where(bad_title, numpy.nan, weight_kg)
+    })
+
+
+def delivery_interval_start(claim):
+    try:
+        return claim['same_day_data']['delivery_interval']['from']
+    except (KeyError, TypeError):
+        return None
+
+
+def flatten_claims_page(page_claims, client_timezone, report_date=None) -> pandas.DataFrame:
+    # One pass over the page pulls only the report fields into rows, the frame is built from those rows at once
+    cutoff_time = pandas.to_datetime(pandas.Series([delivery_interval_start(claim) for claim in page_claims],
+                                                   dtype=object), utc=True).dt.tz_convert(client_timezone)
+    # "YYYY-MM-DDTHH:MM" in the client's time, numpy formats these much faster than strftime
+    cutoff_text = numpy.datetime_as_string(cutoff_time.dt.tz_localize(None).to_numpy().astype("datetime64[m]"))
+    keep = cutoff_time.notna().to_numpy().copy()
+    if report_date:
+        keep &= numpy.char.startswith(cutoff_text, report_date)
+    page_claims = list(itertools.compress(page_claims, keep))
+    if not page_claims:
+        return pandas.DataFrame(columns=REPORT_COLUMNS)
+
+    rows = []
+    for claim in page_claims:
+        pickup, dropoff = claim['route_points'][0], claim['route_points'][1]
+        performer = claim.get('performer_info') or {}
+        courier_name, courier_park = performer.get('courier_name'), performer.get('legal_name')
+        if courier_name is None or courier_park is None:
+            courier_name = courier_park = "No courier yet"
+        return_reason, return_comment = dropoff.get('return_reasons'), dropoff.get('return_comment')
+        if return_reason is None or return_comment is None:
+            return_reason, return_comment = "No return reasons", "No return comments"
+        else:
+            return_reason, return_comment = str(return_reason), str(return_comment)
+        comment, cancel_comment, route_id = claim.get('comment'), claim.get('autocancel_reason'), claim.get('route_id')
+        rows.append((dropoff['external_order_id'], claim['id'], str(dropoff['id']),
+                     "Missing comment in claim" if comment is None else comment,
+                     pickup['address']['fullname'], dropoff['address']['fullname'], dropoff['contact']['phone'],
+                     dropoff['contact']['name'], claim['status'], claim['updated_ts'], pickup['contact']['name'],
+                     courier_name, courier_park, return_reason, return_comment,
+                     "No cancel reasons" if cancel_comment is None else cancel_comment,
+                     "No route" if route_id is None else route_id,
+                     dropoff['address']['coordinates'][0], dropoff['address']['coordinates'][1],
+                     pickup['address']['coordinates'][0], pickup['address']['coordinates'][1]))
+    frame = pandas.DataFrame(rows, columns=FLATTENED_COLUMNS)
+    items_summary = summarize_items(page_claims)
+    return frame.assign(
+        cutoff=[cutoff.replace("T", " ") for cutoff in cutoff_text[keep]],
+        price_of_goods=items_summary["price_of_goods"].to_numpy(),
+        items=items_summary["items"].to_numpy(),
+        extracted_weight=items_summary["extracted_weight"].to_numpy(),
+        type=frame["status"].map(STATUS_TYPES).fillna("?. other"),
+        is_final=frame["status"].map(STATUS_STATES).fillna("unknown")
+    )[REPORT_COLUMNS]
+
+
+@functools.lru_cache(maxsize=None)
+def get_api_budget() -> threading.BoundedSemaphore:
+    return threading.BoundedSemaphore(get_secrets().get("API_BUILD_SLOTS", API_BUILD_SLOTS))
+
+
+def build_report_frame(client, date_from, date_to, report_date=None, sliced=False) -> pandas.DataFrame:
+    with timed_stage("api_budget_wait", client):
+        get_api_budget().acquire()
+    try:
+        return build_budgeted_report_frame(client, date_from, date_to, report_date, sliced)
+    finally:
+        get_api_budget().release()
+
+
+def build_budgeted_report_frame(client, date_from, date_to, report_date=None, sliced=False) -> pandas.DataFrame:
+    client_timezone = get_client_timezone(client)
+    sheets_executor = ThreadPoolExecutor(max_workers=2)
+    pod_orders_future = sheets_executor.submit(get_pod_orders)
+    cod_orders_future = sheets_executor.submit(get_cod_orders)
+    sheets_executor.shutdown(wait=False)
+    if get_claim_store_path():
+        client_today = datetime.datetime.now(timezone(client_timezone)).strftime("%Y-%m-%d")
+        claim_pages = iter_synced_claim_pages(client, date_from, date_to, client_today)
+    elif sliced:
+        claim_pages = iter_sliced_claim_pages(client, date_from, date_to)
+    else:
+        claim_pages = iter_claim_pages(client, date_from, date_to)
+    # Pages are flattened while the next ones download, so only the flattening itself is timed here
+    page_frames = []
+    flatten_seconds = 0.0
+    for page_claims in claim_pages:
+        started = time.perf_counter()
+        page_frames.append(flatten_claims_page(page_claims, client_timezone, report_date))
+        flatten_seconds += time.perf_counter() - started
+    started = time.perf_counter()
+    pages = len(page_frames)
+    page_frames = [page_frame for page_frame in page_frames if not page_frame.empty]
+    result_frame = pandas.concat(page_frames, ignore_index=True) if page_frames \
+        else pandas.DataFrame(columns=REPORT_COLUMNS)
+    log_stage("flatten", client, flatten_seconds + time.perf_counter() - started, pages=pages, rows=len(result_frame))
+    with timed_stage("enrich", client, rows=len(result_frame)):
+        orders_with_pod = pod_orders_future.result()
+        result_frame = calculate_distance(result_frame)
+        result_frame = check_for_pod(result_frame, orders_with_pod)
+        orders_with_cod = cod_orders_future.result()
+#     if client in ["Not specified"]:
+#         result_frame = check_for_cod(result_frame, orders_with_cod)
+#         result_frame.insert(4, 'cash_collected', result_frame.pop('cash_collected'))
+#         result_frame.insert(5, 'cash_prooflink', result_frame.pop('cash_prooflink'))
+#         result_frame.insert(6, 'price_of_goods', result_frame.pop('price_of_goods'))
+    return compact_report_frame(result_frame)
+
+
+def compact_report_frame(frame):
+    # Low-cardinality text as categories, float32 coordinates and numeric goods columns keep cached frames small.
+    # Group by these columns with observed=True, otherwise every category combination shows up.
+    return frame.astype({**{column: "category" for column in CATEGORICAL_COLUMNS if column in frame},
+                         **{column: "float32" for column in COORDINATE_COLUMNS}}) \
+        .assign(price_of_goods=pandas.to_numeric(frame["price_of_goods"], errors="coerce"),
+                extracted_weight=pandas.to_numeric(frame["extracted_weight"], errors="coerce"))
+
+
+def order_report_columns(result_frame, option):
+    if option != "Tomorrow":
+        try:
+            result_frame.insert(3, 'proof', result_frame.pop('proof'))
+        except:
+            print("POD malfunction, skip column reorder")
+    return result_frame
+
+
+def get_report(client, option="Today", start_=None, end_=None) -> pandas.DataFrame:
+    offset_back = DAY_PERIODS.get(option, 0)
+    client_timezone = get_client_timezone(client)
+
+    if not start_:
+        today = datetime.datetime.now(timezone(client_timezone)) - datetime.timedelta(days=offset_back)
+        search_from = today.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=3)
+        search_to = today.replace(hour=23, minute=59, second=59, microsecond=999999)
+        date_from = search_from.strftime("%Y-%m-%d")
+        date_to = search_to.strftime("%Y-%m-%d")
+    else:
+        today = datetime.datetime.now(timezone(client_timezone))
+        date_from_offset = datetime.datetime.fromisoformat(start_).astimezone(
+            timezone(client_timezone)) - datetime.timedelta(days=2)
+        date_from = date_from_offset.strftime("%Y-%m-%d")
+        date_to = end_
+
+    today = today.strftime("%Y-%m-%d")
+    with timed_stage("report", client, period=option) as details:
+        result_frame = build_report_frame(client, date_from, date_to, None if start_ else today, sliced=bool(start_))
+        details["rows"] = len(result_frame)
+    return order_report_columns(result_frame, option)
+
+
+def get_day_reports(client) -> dict:
+    # One claim window covers every day period: it is fetched and flattened once, then sliced by cutoff date
+    client_timezone = get_client_timezone(client)
+    now = datetime.datetime.now(timezone(client_timezone))
+    report_dates = {period: (now - datetime.timedelta(days=offset_back)).strftime("%Y-%m-%d")
+                    for period, offset_back in DAY_PERIODS.items()}
+    date_from = (now - datetime.timedelta(days=max(DAY_PERIODS.values()) + 3)).strftime("%Y-%m-%d")
+    date_to = (now - datetime.timedelta(days=min(DAY_PERIODS.values()))).strftime("%Y-%m-%d")
+    with timed_stage("report", client, period="days") as details:
+        window_frame = build_report_frame(client, date_from, date_to)
+        details["rows"] = len(window_frame)
+    cutoff_positions = window_frame.groupby(window_frame["cutoff"].str[:10]).indices
+    return {period: order_report_columns(
+        window_frame.take(cutoff_positions.get(report_date, [])).reset_index(drop=True), period)
+        for period, report_date in report_dates.items()}
+
+
+class ReportCache:
+    # Process-wide cache of report bundles keyed by (client, period), bounded by entry count and approximate size.
+    # Expired entries are still served while a background rebuild replaces them, and concurrent misses of the same
+    # key wait for the one build in flight instead of crawling the API each.
+
+    def __init__(self, ttl, max_entries, max_bytes, max_workers=4):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (built_at, size, value)
+        self.refreshing = set()
+        self.building = {}  # key -> Future of the first build of a missing key
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get(self, key, build):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                if time.monotonic() - entry[0] > self.ttl and key not in self.refreshing:
+                    self.refreshing.add(key)
+                    self.executor.submit(self.rebuild, key, build)
+                return entry[2]
+            pending = self.building.get(key)
+            if not pending:
+                self.building[key] = Future()
+        if pending:
+            return pending.result()
+        try:
+            value = build()
+            self.put(key, value)
+            self.building[key].set_result(value)
+            return value
+        except BaseException as error:
+            self.building[key].set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.building[key]
+
+    def put(self, key, value):
+        size = report_bundle_size(value)
+        with self.lock:
+            self.entries[key] = (time.monotonic(), size, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries or \
+                    (len(self.entries) > 1 and sum(entry[1] for entry in self.entries.values()) > self.max_bytes):
+                self.entries.popitem(last=False)
+
+    def refresh(self, key, build):
+        # Rebuilds in the calling thread, unless a rebuild of the same key is already running
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+        self.rebuild(key, build)
+        return True
+
+    def rebuild(self, key, build):
+        try:
+            self.put(key, build())
+        except Exception as error:
+            print(f"Background rebuild of {key} failed, keeping the stale report: {error}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def invalidate(self, client):
+        # Marks the client's reports as expired, the next read serves them once more and triggers a rebuild
+        with self.lock:
+            for key, (built_at, size, value) in list(self.entries.items()):
+                if key[0] == client:
+                    self.entries[key] = (float("-inf"), size, value)
+
+    def is_refreshing(self, key):
+        with self.lock:
+            return key in self.refreshing
+
+
+def report_bundle_size(report_bundle):
+    if isinstance(report_bundle, dict):
+        return sum(report_bundle_size(bundle) for bundle in report_bundle.values())
+    return int(report_bundle[0].memory_usage(index=True, deep=True).sum())
+
+
+@functools.lru_cache(maxsize=None)
+def get_report_cache() -> ReportCache:
+    return ReportCache(REPORT_CACHE_TTL, REPORT_CACHE_MAX_ENTRIES, REPORT_CACHE_MAX_BYTES)
+
+
+def aggregate_report(report):
+    # One grouped pass down to store / cutoff time / courier / route / status / proof, every KPI and the route pivot
+    # are read off this small table instead of the full report
+    return report[[*KPI_DIMENSIONS, "claim_id"]] \
+        .assign(cutoff=report["cutoff"].str.split(' ').str[1]) \
+        .groupby(KPI_DIMENSIONS, observed=True, dropna=False)["claim_id"].nunique() \
+        .rename("claims").reset_index()
+
+
+def select_aggregates(aggregates, include=None, exclude=None):
+    mask = numpy.ones(len(aggregates), dtype=bool)
+    for column, values in (include or {}).items():
+        if values:
+            mask &= aggregates[column].isin(values).to_numpy()
+    for column, values in (exclude or {}).items():
+        if values:
+            mask &= ~aggregates[column].isin(values).to_numpy()
+    return aggregates[mask]
+
+
+def build_route_pivot(aggregates, include=None, exclude=None):
+    # Distinct claims per store / cutoff / courier and status type, same shape as the former pivot_table
+    return select_aggregates(aggregates, include, exclude) \
+        .groupby(["store_name", "cutoff", "courier_name", "type"], observed=True)["claims"].sum() \
+        .unstack("type", fill_value="-").reset_index()
+
+
+def summarize_report(report):
+    aggregates = aggregate_report(report)
+    routes_not_taken = select_aggregates(aggregates,
+                                         include={"courier_name": ["No courier yet"]},
+                                         exclude={"status": ["cancelled", "performer_not_found", "failed"],
+                                                  "route_id": ["No route"]}) \
+        .groupby(['courier_name', 'route_id', 'store_name'], observed=True)['claims'].sum().reset_index()
+    proof_provided = select_aggregates(aggregates, include={"proof": ["Proof provided"]})["claims"].sum()
+    delivered_today = int(select_aggregates(aggregates, include={"status": DELIVERED_STATUSES})["claims"].sum())
+    pod_provision_rate = f"{proof_provided / delivered_today:.0%}" if delivered_today else "--"
+    report.attrs["report_version"] = time.time_ns()  # tells exports of different builds apart
+    return report, routes_not_taken, pod_provision_rate, delivered_today, build_filter_index(report), aggregates
+
+
+def build_filter_index(report):
+    # Row positions per value of every filterable column, built once per cached report
+    return {column: report.groupby(column, observed=True).indices for column in FILTER_COLUMNS if column in report}
+
+
+def index_positions(filter_index, column, values):
+    positions = [filter_index[column][value] for value in values if value in filter_index[column]]
+    return numpy.unique(numpy.concatenate(positions)) if positions else numpy.array([], dtype=numpy.intp)
+
+
+def filter_positions(filter_index, within, include=None, exclude=None):
+    # Narrows the sorted row positions in `within` to rows matching every non-empty include list
+    # and none of the exclude lists
+    positions = within
+    for column, values in (include or {}).items():
+        if values:
+            positions = numpy.intersect1d(positions, index_positions(filter_index, column, values), assume_unique=True)
+    for column, values in (exclude or {}).items():
+        if values:
+            positions = numpy.setdiff1d(positions, index_positions(filter_index, column, values), assume_unique=True)
+    return positions
+
+
+def get_period_report(client, period):
+    if period in REPORT_RANGES:
+        start_, end_ = REPORT_RANGES[period]
+        return get_report(client, period, start_=start_, end_=end_)
+    return get_report(client, period)
+
+
+def report_output_path(output_dir, client, period, export_format):
+    client_slug = re.sub(r"[^a-z0-9]+", "_", client.lower()).strip("_")
+    return os.path.join(output_dir, f"{client_slug}_{period.lower()}.{export_format}")
+
+
+def write_xlsx(report, path):
+    # constant_memory flushes every row as soon as the next one starts, so rows must be written strictly in order,
+    # which pandas.to_excel doesn't do
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('routes_report')
+    worksheet.write_row(0, 0, ["", *report.columns])
+    for row_number, row in enumerate(report.itertuples(name=None), start=1):
+        worksheet.write_row(row_number, 0, [None if value != value else value for value in row])  # NaN as blank
+    workbook.close()
+
+
+def write_parquet(report, path):
+    # Text columns may mix defaults with values of other types, which parquet doesn't accept
+    report = report.astype({column: str for column in report.select_dtypes("object")})
+    writer = None
+    try:
+        for start in range(0, max(len(report), 1), EXPORT_CHUNK_ROWS):
+            chunk = pyarrow.Table.from_pandas(report.iloc[start:start + EXPORT_CHUNK_ROWS], preserve_index=False,
+                                              schema=writer.schema if writer else None)
+            writer = writer or pyarrow.parquet.ParquetWriter(path, chunk.schema)
+            writer.write_table(chunk)
+    finally:
+        if writer:
+            writer.close()
+
+
+def export_report(report, path, export_format):
+    # Written next to the target and renamed, so a concurrent reader never picks up a half written file
+    partial_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    if export_format == "parquet":
+        write_parquet(report, partial_path)
+    elif export_format == "csv":
+        report.to_csv(partial_path, chunksize=EXPORT_CHUNK_ROWS)
+    else:
+        write_xlsx(report, partial_path)
+    os.replace(partial_path, path)
+    return path
+
+
+def get_export_path(client, period, report_version, export_format, filters=None):
+    # Keyed by the version summarize_report stamped on the report, so the path is known without taking any rows
+    export_key = repr((client, period, report_version, sorted((filters or {}).items())))
+    export_dir = get_secrets().get("EXPORTS_DIR", os.path.join(tempfile.gettempdir(), "route_report_exports"))
+    return report_output_path(export_dir, client, f"{period}_{hashlib.sha1(export_key.encode()).hexdigest()[:16]}",
+                              export_format)
+
+
+def get_cached_export(client, period, report, export_format, filters=None):
+    # Exports are built on demand and shared between sessions until the report they were made from is rebuilt
+    path = get_export_path(client, period, report.attrs.get("report_version"), export_format, filters)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with timed_stage("export", client, period=period, format=export_format, rows=len(report)) as details:
+            export_report(report, path, export_format)
+            details["bytes"] = os.path.getsize(path)
+        prune_exports(os.path.dirname(path))
+    return path
+
+
+def prune_exports(export_dir):
+    exports = sorted((entry for entry in os.scandir(export_dir) if entry.is_file()),
+                     key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in exports[EXPORT_CACHE_MAX_FILES:]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def timed_summary(client, period, report):
+    with timed_stage("aggregate", client, period=period, rows=len(report)):
+        return summarize_report(report)
+
+
+def build_report_bundle(client, period):
+    precomputed_path = report_output_path(get_secrets().get("PRECOMPUTED_REPORTS_DIR", "reports"), client, period,
+                                          "parquet")
+    if period in REPORT_RANGES and os.path.exists(precomputed_path):
+        with timed_stage("precomputed_read", client, period=period):
+            report = pandas.read_parquet(precomputed_path)
+        return timed_summary(client, period, report)
+    return timed_summary(client, period, get_period_report(client, period))
+
+
+def build_day_report_bundles(client):
+    return {period: timed_summary(client, period, report) for period, report in get_day_reports(client).items()}
+
+
+def report_cache_key(client, period):
+    return (client, "days") if period in DAY_PERIODS else (client, period)
+
+
+def get_cached_report(client, period):
+    # The cached frames are shared between sessions, never modify them in place
+    with timed_stage("cached_report", client, period=period):
+        if period in DAY_PERIODS:
+            return get_report_cache().get(report_cache_key(client, period),
+                                          lambda: build_day_report_bundles(client))[period]
+        return get_report_cache().get(report_cache_key(client, period), lambda: build_report_bundle(client, period))
+
+
+class ReportPrefetcher:
+    # Keeps the day reports of hot clients fresh in the report cache from a background thread. Clients are rebuilt
+    # one after another every interval seconds, counted from offset seconds past the hour, and the first round
+    # after XX:00 re-reads the sheets the hourly POD sync just updated.
+
+    def __init__(self, clients, interval=PREFETCH_INTERVAL, offset=PREFETCH_OFFSET):
+        self.clients = clients
+        self.interval = interval
+        self.offset = offset
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="report-prefetch", daemon=True)
+
+    def seconds_to_next_round(self, now):
+        return (now - self.offset) // self.interval * self.interval + self.interval + self.offset - now
+
+    def run(self):
+        self.refresh_clients()  # warm up right away instead of waiting for the first round
+        while not self.stop_event.wait(self.seconds_to_next_round(time.time())):
+            if (time.time() - self.offset) % 3600 < self.interval:
+                get_pod_orders.cache_clear()
+                get_cod_orders.cache_clear()
+            self.refresh_clients()
+
+    def refresh_clients(self):
+        for client in self.clients:
+            if self.stop_event.is_set():
+                break
+            with timed_stage("prefetch", client) as details:
+                details["refreshed"] = get_report_cache().refresh(report_cache_key(client, "Today"),
+                                                                  lambda: build_day_report_bundles(client))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+@functools.lru_cache(maxsize=None)
+def start_report_prefetcher():
+    # Once per process, HOT_CLIENTS lists the clients to keep warm and an empty list disables prefetching
+    clients = [client for client in get_secrets().get("HOT_CLIENTS", []) if client in SECRETS_MAP]
+    if not clients:
+        return None
+    prefetcher = ReportPrefetcher(clients, get_secrets().get("PREFETCH_INTERVAL", PREFETCH_INTERVAL))
+    prefetcher.thread.start()
+    return prefetcher
+
+
+def build_map_data(report, filter_index, positions, max_points=None):
+    # Only the columns the map needs, one color per row and one point per store. Above max_points, orders are
+    # binned into grid cells here instead of shipping every point to the browser. Every layer's rows carry their own
+    # ready-made tooltip text, so the deck tooltip never refers to a field a layer doesn't have.
+    max_points = max_points or get_secrets().get("MAP_MAX_POINTS", 20000)
+    if not len(positions):
+        return pandas.DataFrame(columns=[*MAP_ORDER_COLUMNS, "color", "tooltip"]), \
+            pandas.DataFrame(columns=["store_name", "store_lon", "store_lat", "cutoff", "tooltip"]), False
+    orders = report.take(positions)
+    colors = numpy.tile(numpy.array(MAP_IN_DELIVERY_COLOR), (len(positions), 1))
+    delivered = numpy.isin(positions, index_positions(filter_index, "status", MAP_STATUS_COLORS[0][0]))
+    for map_statuses, color in MAP_STATUS_COLORS:
+        colors[numpy.isin(positions, index_positions(filter_index, "status", map_statuses))] = color
+
+    cutoff_times = orders['cutoff'].str.split(' ').str[1]
+    stores = orders[['store_name', 'store_lon', 'store_lat']].assign(cutoff=cutoff_times) \
+        .groupby(['store_name', 'store_lon', 'store_lat'], observed=True)['cutoff'] \
+        .agg(lambda x: ', '.join(x.unique())).reset_index()
+    stores["tooltip"] = stores["store_name"].astype(str) + " : " + stores["cutoff"].astype(str)
+
+    aggregated = len(orders) > max_points
+    if aggregated:
+        cells = pandas.DataFrame({"lon": (orders["lon"].to_numpy() / MAP_GRID_DEGREES).round() * MAP_GRID_DEGREES,
+                                  "lat": (orders["lat"].to_numpy() / MAP_GRID_DEGREES).round() * MAP_GRID_DEGREES,
+                                  "delivered": delivered})
+        points = cells.groupby(["lon", "lat"]).agg(orders=("delivered", "size"),
+                                                   delivered=("delivered", "sum")).reset_index()
+        delivered_share = (points["delivered"] / points["orders"]).to_numpy()[:, None]
+        points["color"] = numpy.rint(numpy.array(MAP_STATUS_COLORS[0][1]) * delivered_share +
+                                     numpy.array(MAP_IN_DELIVERY_COLOR) * (1 - delivered_share)).astype(int).tolist()
+        points["radius"] = 100 + 400 * numpy.sqrt(points["orders"] / points["orders"].max())
+        points["tooltip"] = points["orders"].astype(str) + " orders, " + points["delivered"].astype(str) + " delivered"
+    else:
+        points = orders[MAP_ORDER_COLUMNS].assign(color=colors.tolist())
+        text = points[["store_name", "cutoff", "courier_name", "status", "client_id", "claim_id"]].astype(str)
+        points["tooltip"] = text["store_name"] + " : " + text["cutoff"] + "\n" + text["courier_name"] + " : " + \
+            text["status"] + "\n" + text["client_id"] + " : " + text["claim_id"]
+    return points, stores, aggregated
+
+
+def search_positions(frame, positions, columns, text):
+    # Keeps the positions whose row contains text in any of the columns, categories are searched once per value
+    if not text:
+        return positions
+    matches = numpy.zeros(len(positions), dtype=bool)
+    for column in columns:
+        values = frame[column].take(positions)
+        if isinstance(values.dtype, pandas.CategoricalDtype):
+            hits = values.cat.categories.astype(str).str.contains(text, case=False, regex=False)
+            matches |= numpy.isin(values.cat.codes.to_numpy(), numpy.flatnonzero(hits))
+        else:
+            matches |= values.astype(str).str.contains(text, case=False, regex=False).to_numpy()
+    return positions[matches]
+
+
+def sort_positions(frame, positions, sort_by, ascending=True):
+    if not sort_by:
+        return positions
+    values = frame[sort_by].take(positions).reset_index(drop=True)
+    try:
+        order = values.sort_values(ascending=ascending, kind="stable").index
+    except TypeError:
+        # pivot counts are mixed with "-" placeholders
+        order = values.astype(str).sort_values(ascending=ascending, kind="stable").index
+    return positions[order.to_numpy()]
+
+
+def table_positions(frame, positions, columns, search=None, sort_by=None, ascending=True):
+    return sort_positions(frame, search_positions(frame, positions, columns, search), sort_by, ascending)
+
+
+def table_page(frame, positions, columns, page, page_size):
+    # Only the rows and columns of one page are copied out of the cached frame
+    return frame.take(positions[(page - 1) * page_size:page * page_size])[columns]
+
+
+def summarize_fleet(fleet_frame, clients, errors=None):
+    # Per-client routes, POD and delivery metrics in a single grouped pass over the combined frame. Clients whose
+    # report failed keep blank metrics and the error in status, so they don't pass for a day without orders.
+    errors = errors or {}
+    delivered = fleet_frame['status'].isin(['delivered', 'delivered_finish'])
+    not_pickuped = ~fleet_frame['status'].isin(["cancelled", "performer_not_found", "failed"]) & \
+        (fleet_frame['courier_name'] == "No courier yet") & (fleet_frame['route_id'] != "No route")
+    route_keys = fleet_frame['route_id'].astype(str) + "|" + fleet_frame['store_name'].astype(str)
+    fleet_summary = fleet_frame.assign(delivered=delivered,
+                                       proof_provided=fleet_frame['proof'] == "Proof provided",
+                                       not_pickuped_route=route_keys.where(not_pickuped)) \
+        .groupby('client') \
+        .agg(not_pickuped_routes=('not_pickuped_route', 'nunique'),
+             proof_provided=('proof_provided', 'sum'),
+             delivered=('delivered', 'sum')) \
+        .reindex(clients)
+    succeeded = ~fleet_summary.index.isin(list(errors))
+    fleet_summary.loc[succeeded] = fleet_summary.loc[succeeded].fillna(0)
+    fleet_summary['pod_provision_rate'] = (fleet_summary['proof_provided'] / fleet_summary['delivered']) \
+        .map(lambda rate: f"{rate:.0%}" if numpy.isfinite(rate) else "--")
+    fleet_summary['status'] = [f"Failed: {errors[client]}" if client in errors else "OK" for client in clients]
+    return fleet_summary.rename_axis('client').reset_index()
+
+
+def get_fleet_report(period, clients=None, max_workers=FLEET_MAX_WORKERS):
+    clients = clients or list(SECRETS_MAP)
+    reports = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_cached_report, client, period): client for client in clients}
+        for future in as_completed(futures):
+            try:
+                reports[futures[future]] = future.result()[0]
+            except Exception as error:
+                print(f"Skipping {futures[future]} in the fleet overview: {error}")
+                errors[futures[future]] = error
+    # Reruns reuse the summary until one of the cached reports is rebuilt or a client's build result changes
+    summary_key = (period, tuple((client, reports[client].attrs.get("report_version") if client in reports
+                                  else repr(errors[client])) for client in clients))
+    with FLEET_SUMMARIES_LOCK:
+        if summary_key in FLEET_SUMMARIES:
+            return FLEET_SUMMARIES[summary_key]
+    fleet_frame = pandas.DataFrame(columns=[*REPORT_COLUMNS, 'proof', 'client'])
+    if reports:
+        fleet_frame = pandas.concat([reports[client].assign(client=client) for client in clients if client in reports],
+                                    ignore_index=True)
+    fleet_report = summarize_fleet(fleet_frame, clients, errors), len(fleet_frame)
+    with FLEET_SUMMARIES_LOCK:
+        FLEET_SUMMARIES[summary_key] = fleet_report
+    return fleet_report
+
+
+def export_client_reports(client, periods, export_formats, output_dir):
+    paths = []
+    for period in periods:
+        report = get_period_report(client, period)
+        for export_format in export_formats:
+            paths.append(report_output_path(output_dir, client, period, export_format))
+            export_report(report, paths[-1], export_format)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build route reports without the dashboard.")
+    parser.add_argument("--client", action="append", choices=list(SECRETS_MAP),
+                        help="client to build, repeatable (default: every client)")
+    parser.add_argument("--period", action="append", choices=[*DAY_PERIODS, *REPORT_RANGES],
+                        help="report period, repeatable (default: Monthly)")
+    parser.add_argument("--format", action="append", choices=EXPORT_FORMATS, dest="formats",
+                        help="output format, repeatable (default: parquet)")
+    parser.add_argument("--output-dir", default="reports")
+    parser.add_argument("--workers", type=int, default=4, help="clients built in parallel")
+    parser.add_argument("--secrets", default=SECRETS_PATH, help="path to the secrets.toml with API and sheet keys")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    clients = args.client or list(SECRETS_MAP)
+    failed_clients = []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=configure,
+                             initargs=(toml.load(args.secrets),)) as executor:
+        futures = {executor.submit(export_client_reports, client, args.period or ["Monthly"],
+                                   args.formats or ["parquet"], args.output_dir): client for client in clients}
+        for future in as_completed(futures):
+            try:
+                for path in future.result():
+                    print(f"WROTE {path}")
+            except Exception as error:
+                print(f"FAILED {futures[future]}: {error}")
+                failed_clients.append(futures[future])
+    return 1 if failed_clients else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())